@@ -122,6 +122,13 @@ class ADAgent(DefaultParty):
 
         # Finished will be send if the negotiation has ended (through agreement or deadline)
         elif isinstance(data, Finished):
+            # Apply the remaining buffered Q-learning transitions. A failure must not prevent saving and terminating.
+            if self.opponent_model is not None:
+                try:
+                    self.opponent_model.flush_batch()
+                except Exception as e:
+                    self.getReporter().log(logging.WARNING, "Q-learning update failed: %s" % e)
+
             # Save data
             if self.learning_model is not None:
                 self.learning_model.save_data(self.storage_dir, self.other)
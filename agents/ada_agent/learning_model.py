@@ -1,11 +1,14 @@
 from agents.ada_agent.utils import *
-import os
+import gzip
 import pickle
+from collections import deque
 
 from geniusweb.issuevalue import Bid
 from geniusweb.profile.utilityspace import LinearAdditiveUtilitySpace
 from geniusweb.progress import ProgressTime
 
+GZIP_MAGIC = b"\x1f\x8b"
+
 
 class LearningModel:
     """
@@ -13,9 +16,10 @@ class LearningModel:
     """
     profile: LinearAdditiveUtilitySpace
     progress: ProgressTime
-    received_bids: list                 # Received bids
-    my_bids: list                       # Generated bids by Bidding Strategy
+    received_bids: deque                # Last received bids
+    my_bids: deque                      # Last generated bids by Bidding Strategy
     data: dict                          # Data will be saved.
+    max_history: int = 1000             # Maximum number of bids kept in the history
 
     def __init__(self, profile: LinearAdditiveUtilitySpace, progress: ProgressTime, **kwargs):
         """
@@ -26,8 +30,8 @@ class LearningModel:
         """
         self.profile = profile
         self.progress = progress
-        self.received_bids = []
-        self.my_bids = []
+        self.received_bids = deque(maxlen=self.max_history)
+        self.my_bids = deque(maxlen=self.max_history)
         self.data = {}
 
     def receive_bid(self, curr_bid, prev_bid, reward, learning_rate, discount_factor):
@@ -75,9 +79,11 @@ class LearningModel:
         if opponent_agent is None or storage_dir is None:
             return
 
-        # Save the data as Pickle format.
-        with open(f"{storage_dir}/{opponent_agent}_data.pkl", "wb") as f:
-            pickle.dump(self.data, f)
+        payload = pickle.dumps(self.data, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Save the data in compressed format.
+        with open(f"{storage_dir}/{opponent_agent}_data.pkl", "wb") as f, gzip.GzipFile(fileobj=f, mode="wb") as z:
+            z.write(payload)
 
     def load_data(self, storage_dir: str, opponent_agent: str) -> dict:
         """
@@ -92,15 +98,30 @@ class LearningModel:
         if storage_dir is None or opponent_agent is None:
             return self.data
 
-        # Load corresponding data
-        if os.path.exists(f"{storage_dir}/{opponent_agent}_data.pkl"):
-            with open(f"{storage_dir}/{opponent_agent}_data.pkl", "rb") as f:
-                self.data = pickle.load(f)
+        # Load corresponding data, if exists
+        try:
+            f = open(f"{storage_dir}/{opponent_agent}_data.pkl", "rb")
+        except FileNotFoundError:
+            return self.data
 
-        return self.data
+        with f:
+            self.data = pickle.loads(decompress(f))
 
+        return self.data
 
 
+def decompress(f) -> bytes:
+    """
+        Read a file which may be compressed by gzip. Uncompressed files of earlier sessions are also supported.
+    :param f: File opened in binary mode
+    :return: Decompressed content
+    """
+    magic = f.read(2)
+    f.seek(0)
 
+    if magic == GZIP_MAGIC:
+        with gzip.GzipFile(fileobj=f, mode="rb") as z:
+            return z.read()
 
+    return f.read()
 
@@ -1,3 +1,6 @@
+import itertools
+from collections import defaultdict
+
 from geniusweb.issuevalue.Bid import Bid
 from geniusweb.issuevalue.DiscreteValueSet import DiscreteValueSet
 from geniusweb.issuevalue.Domain import Domain
@@ -15,12 +18,17 @@ class OpponentModel:
     """
     profile: LinearAdditiveUtilitySpace
     progress: ProgressTime
-    offers: list  # Received bids
+    num_offers: int  # Number of received bids
     domain: Domain  # Agent's domain
     issues: dict  # Issues
     alpha: float  # Learning rate
     gamma: float  # Discount factor
-    q_table: dict  # Q-table
+    initial_capacity: int = 64  # Initial number of rows (states) in the Q-table
+    batch_size: int = 32  # Number of buffered transitions that triggers a Q-learning update
+    utility_cache_size: int = 512  # Maximum number of cached estimated utilities
+    state_issues: tuple = ('price', 'quantity')  # Issues which define the state, if they exist in the domain
+    update_eps: float = 1e-4  # Minimum time difference between two learning updates
+    q_table: np.ndarray  # Q-table, rows are state IDs and columns are action IDs
 
     def __init__(self, domain: Domain, profile: LinearAdditiveUtilitySpace, progress: ProgressTime,
                  alpha: float = 0.1, gamma: float = 0.9):
@@ -37,17 +45,80 @@ class OpponentModel:
         self.progress = progress
         self.alpha = alpha
         self.gamma = gamma
-        self.offers = []  # List to store received bids
+        self.num_offers = 0  # Received bids are not stored, only the values of the last two received bids are kept
+
+        # Domain calls are invariant during the session, so the issues and their values are materialized once.
+        self._issues_frozen = tuple(domain.getIssues())
+        self._values_frozen = {issue: tuple(domain.getValues(issue)) for issue in self._issues_frozen}
+
+        self.issues = {issue: Issue(values) for issue, values in self._values_frozen.items()}
+
+        # Issue and value weights are also packed into arrays for get_utility. The issue weight and the value weight
+        # array of each Issue become views into these arrays, so the arrays are the only storage of the weights. Each
+        # value is mapped to its index in the flat value weight array. The last element is a zero weight used for
+        # missing values.
+        offsets = np.cumsum([0] + [len(self._values_frozen[issue_name]) for issue_name in self._issues_frozen])
+        self._value_to_id = tuple({value: offset + i for value, i in self.issues[issue_name].value_index.items()}
+                                  for issue_name, offset in zip(self._issues_frozen, offsets))
+        self._issue_weights = np.array([self.issues[issue_name].weight for issue_name in self._issues_frozen],
+                                       dtype=np.float32)
+        self._value_weights_lookup = np.zeros(offsets[-1] + 1, dtype=np.float32)
+
+        for i, (issue_name, start, end) in enumerate(zip(self._issues_frozen, offsets[:-1], offsets[1:])):
+            issue_obj = self.issues[issue_name]
+            issue_obj.weight_arr = self._issue_weights[i:i + 1]
+            self._value_weights_lookup[start:end] = issue_obj.value_weights_arr
+            issue_obj.value_weights_arr = self._value_weights_lookup[start:end]
+            issue_obj.on_change = self.clear_utility_cache
+
+        self._value_weights_arrays = tuple(self.issues[issue_name].value_weights_arr
+                                           for issue_name in self._issues_frozen)
+
+        # Estimated utilities cached by id(bid); the bids are kept alive so that their IDs are not reused.
+        self._utility_cache = {}
+        self._utility_bid_refs = []
 
-        self.issues = {issue: Issue(values) for issue, values in domain.getIssuesValues().items()}
         self.normalize()
 
-        # Initialize Q-table
-        self.q_table = {}
+        # Ring buffer of the issue values of the last two received bids, in the order of the issue names
+        self._last_two_vals = [None, None]
+        self._last_two_idx = 0
+        self._last_update_t = -1.0  # Time of the last learning update
+
+        # Initialize Q-table. Actions are the values of the first issue; states are assigned IDs lazily.
+        self._first_issue = self._issues_frozen[0]
+        # The last column is used for a missing or unknown value of the first issue, and it is excluded from the
+        # maximum Q-value of a state.
+        self._action_to_id = {value: i for i, value in enumerate(self._values_frozen[self._first_issue])}
+        self._missing_action_id = len(self._action_to_id)
+        self._state_to_id = defaultdict(itertools.count().__next__)
+        self.q_table = np.zeros((self.initial_capacity, len(self._action_to_id) + 1), dtype=np.float32)
+        self._state_max_q = np.zeros(self.initial_capacity, dtype=np.float32)  # Maximum Q-value of each state
+        self._transitions = []  # Buffered (prev_bid, curr_bid, reward, learning_rate, discount_factor)
+
+        # State representations cached by id(bid); the bids are kept alive so that their IDs are not reused.
+        self._state_cache = {}
+        self._bid_refs = []
+
+        # The state issues are fixed for the session, so a function returning the state as a single integer is
+        # compiled. Each state issue value is coded by its index (the number of values for a missing value), and the
+        # codes are packed in mixed radix.
+        namespace = {}
+        terms = []
+        radix = 1
+        for i, issue_name in enumerate(issue_name for issue_name in self.state_issues if issue_name in self.issues):
+            namespace["codes%d" % i] = {value: code for code, value in enumerate(self._values_frozen[issue_name])}
+            num_values = len(self._values_frozen[issue_name])
+            terms.append("codes%d.get(bid.getValue(%r), %d) * %d" % (i, issue_name, num_values, radix))
+            radix *= num_values + 1
+
+        exec("def state_of(bid):\n    return %s\n" % (" + ".join(terms) or "0"), namespace)
+        self._state_of = namespace["state_of"]
 
     def update(self, prev_bid: Bid, curr_bid: Bid, reward: float, learning_rate: float, discount_factor: float):
         """
-        This method is called when a new bid is received. It updates the opponent model and performs Q-learning update.
+        This method is called when a new bid is received. It updates the opponent model and buffers the transition for
+        the batch Q-learning update.
         :param prev_bid: Previous bid
         :param curr_bid: Current bid
         :param reward: Reward associated with the current bid
@@ -58,44 +129,109 @@ class OpponentModel:
         if prev_bid is None or curr_bid is None:
             return
 
-        self.offers.append(curr_bid)
+        self.num_offers += 1
+
+        # The ring buffer is written before the update_eps check, so skipped bids are also recorded.
+        self._last_two_vals[self._last_two_idx] = np.array([curr_bid.getValue(issue_name)
+                                                            for issue_name in self._issues_frozen], dtype=object)
+        self._last_two_idx ^= 1
+
+        # Time is effectively constant during a single update, so it is queried once.
+        t = get_time(self.progress)
+
+        # Skip learning if the time has not advanced since the last update, e.g. many bids in the same progress tick.
+        # The first two bids are always learned.
+        if t - self._last_update_t < self.update_eps and self.num_offers > 2:
+            return
+
+        self._last_update_t = t
+
+        self.update_issue_weights(t)
 
-        self.update_issue_weights()
+        self._transitions.append((prev_bid, curr_bid, reward, learning_rate, discount_factor))
 
-        self.q_learning_update(prev_bid, curr_bid, reward, learning_rate, discount_factor)
+        if len(self._transitions) >= self.batch_size:
+            self.flush_batch()
 
-    def update_issue_weights(self):
+    def update_issue_weights(self, t: float):
         """
-        This method updates the issue weights by considering the last two consecutive bids.
+        This method updates the issue weights by considering the last two received bids.
+        :param t: Current negotiation time
         :return: Nothing
         """
-        t = get_time(self.progress)
-
-        if len(self.offers) < 2:
+        if self._last_two_vals[0] is None or self._last_two_vals[1] is None:
             return
 
-        last_two_bids = self.offers[-2:]
+        # Issue.weight is a view into the issue weight array, so it is updated as well.
+        equal_mask = self._last_two_vals[0] == self._last_two_vals[1]
 
-        for issue_name, issue_obj in self.issues.items():
-            if last_two_bids[0].getValue(issue_name) == last_two_bids[1].getValue(issue_name):
-                issue_obj.weight += self.alpha * (1.0 - t * 3)
+        if equal_mask.any():
+            self._issue_weights += equal_mask * (self.alpha * (1.0 - 3.0 * t))
 
-    def q_learning_update(self, prev_bid: Bid, curr_bid: Bid, reward: float, learning_rate: float,
-                          discount_factor: float):
-        prev_state = self.get_state_representation(prev_bid)
-        prev_action = prev_bid.getValue(list(self.domain.getIssues())[0]) if prev_bid else None
-        curr_state = self.get_state_representation(curr_bid)
-        curr_action = curr_bid.getValue(list(self.domain.getIssues())[0]) if curr_bid else None
+            self.clear_utility_cache()
 
-        # Update Q-table
-        prev_q_value = self.q_table.get((prev_state, prev_action), 0.0)
+    def flush_batch(self):
+        """
+        Q-learning update over all buffered transitions in a single vectorized sweep.
+        :return: Nothing
+        """
+        if len(self._transitions) == 0:
+            return
 
-        issue_name = list(self.domain.getIssues())[0]
-        values = self.domain.getValues(issue_name)
-        max_q_value = max(self.q_table.get((curr_state, a), 0.0) for a in values)
+        # State IDs are resolved before indexing, since a new state may grow the Q-table.
+        sid_prev = np.array([self.get_state_id(self.get_state_representation(prev_bid))
+                             for prev_bid, _, _, _, _ in self._transitions], dtype=np.intp)
+        aid_prev = np.array([self._action_to_id.get(prev_bid.getValue(self._first_issue), self._missing_action_id)
+                             for prev_bid, _, _, _, _ in self._transitions], dtype=np.intp)
+        sid_curr = np.array([self.get_state_id(self.get_state_representation(curr_bid))
+                             for _, curr_bid, _, _, _ in self._transitions], dtype=np.intp)
+        rewards, learning_rates, discount_factors = np.array([transition[2:] for transition in self._transitions],
+                                                             dtype=np.float32).T
+
+        self._transitions.clear()
+        self._state_cache.clear()
+        self._bid_refs.clear()
+
+        max_q_values = self._state_max_q[sid_curr]
+        targets = rewards + discount_factors * max_q_values
+
+        # Repeated state-action pairs in the batch are updated once by their average step, so that each Q-value
+        # moves towards the targets instead of summing one full step per repeat.
+        num_actions = self.q_table.shape[1]
+        pairs, inverse = np.unique(sid_prev * num_actions + aid_prev, return_inverse=True)
+        deltas = learning_rates * (targets - self.q_table[sid_prev, aid_prev])
+        steps = np.bincount(inverse, weights=deltas) / np.bincount(inverse)
+
+        sids, aids = np.divmod(pairs, num_actions)
+        prev_q_values = self.q_table[sids, aids]
+        new_q_values = (prev_q_values + steps).astype(np.float32)
+        self.q_table[sids, aids] = new_q_values
+
+        # Increasing writes only raise the maximum. The maximum is re-derived only for states with a decreasing write.
+        known = aids != self._missing_action_id
+        np.maximum.at(self._state_max_q, sids[known], new_q_values[known])
+
+        decreased = np.unique(sids[known & (new_q_values < prev_q_values)])
+        if decreased.size > 0:
+            self._state_max_q[decreased] = self.q_table[decreased, :-1].max(axis=1)
+
+    def get_state_id(self, state: int) -> int:
+        """
+        Map a state into its row in the Q-table. The Q-table grows if the state is new.
+        :param state: State representation (integer)
+        :return: State ID
+        """
+        state_id = self._state_to_id[state]
+
+        if state_id >= self.q_table.shape[0]:
+            # np.resize repeats the content, so the new rows are reset to zero.
+            num_rows = self.q_table.shape[0]
+            self.q_table = np.resize(self.q_table, (2 * num_rows, self.q_table.shape[1]))
+            self.q_table[num_rows:] = 0.0
+            self._state_max_q = np.resize(self._state_max_q, 2 * num_rows)
+            self._state_max_q[num_rows:] = 0.0
 
-        new_q_value = (1 - learning_rate) * prev_q_value + learning_rate * (reward + discount_factor * max_q_value)
-        self.q_table[(prev_state, prev_action)] = new_q_value
+        return state_id
 
     # def get_state_representation(self, bid: Bid) -> tuple:
     #     """
@@ -105,21 +241,22 @@ class OpponentModel:
     #     """
     #     # TODO: Implement the state representation based on your negotiation scenario
     #     # Return a tuple that represents the current state given the bid
-    def get_state_representation(self, bid: Bid) -> tuple:
+    def get_state_representation(self, bid: Bid) -> int:
         """
         Convert a bid into a state representation.
         :param bid: Bid object
-        :return: State representation (tuple)
+        :return: State representation (integer)
         """
-        state = []
+        key = id(bid)
+        state = self._state_cache.get(key)
 
-        price_value = bid.getValue('price')
-        state.append(price_value)
+        if state is None:
+            state = self._state_of(bid)
 
-        quantity_value = bid.getValue('quantity')
-        state.append(quantity_value)
+            self._state_cache[key] = state
+            self._bid_refs.append(bid)
 
-        return tuple(state)
+        return state
 
     def get_utility(self, bid: Bid) -> float:
         """
@@ -130,12 +267,29 @@ class OpponentModel:
         if bid is None:
             return 0.0
 
-        total = 0.0
+        key = id(bid)
+        utility = self._utility_cache.get(key)
+
+        if utility is None:
+            utility = self.compute_utility(bid)
+
+            if len(self._utility_cache) < self.utility_cache_size:
+                self._utility_cache[key] = utility
+                self._utility_bid_refs.append(bid)
 
-        for issue_name, issue_obj in self.issues.items():
-            total += issue_obj.get_utility(bid.getValue(issue_name))
+        return utility
 
-        return total
+    def compute_utility(self, bid: Bid) -> float:
+        """
+        Calculate the estimated utility without the cache.
+        :param bid: The bid to be calculated.
+        :return: Estimated utility
+        """
+        value_ids = np.fromiter((value_to_id.get(bid.getValue(issue_name), -1)
+                                 for issue_name, value_to_id in zip(self._issues_frozen, self._value_to_id)),
+                                dtype=np.intp, count=len(self._issues_frozen))
+
+        return float((self._issue_weights * self._value_weights_lookup[value_ids]).sum())
 
     def normalize(self):
         """
@@ -144,24 +298,32 @@ class OpponentModel:
         - The sum of issue weights must be 1.0
         :return: Nothing
         """
-        total_issue_weight = 0.0
-        for issue_name, issue_obj in self.issues.items():
-            total_issue_weight += issue_obj.weight
-            max_val = max(issue_obj.value_weights.values())
+        np.divide(self._issue_weights, self._issue_weights.sum(), out=self._issue_weights)
 
-            for value_name in issue_obj.value_weights:
-                issue_obj.value_weights[value_name] /= max_val
+        # Single pass over the issues; value weights are normalized in place.
+        for value_weights in self._value_weights_arrays:
+            np.divide(value_weights, value_weights.max(), out=value_weights)
 
-        for issue_obj in self.issues.values():
-            issue_obj.weight /= total_issue_weight
+        # Weights are changed, so the cached utilities are outdated.
+        self.clear_utility_cache()
+
+    def clear_utility_cache(self):
+        """
+        Clear the cached estimated utilities. It must be called whenever an issue or value weight changes.
+        :return: Nothing
+        """
+        self._utility_cache.clear()
+        self._utility_bid_refs.clear()
 
 
 class Issue:
     """
         This class can be used to estimate issue weight and value weights.
     """
-    weight: float = 1.0  # Issue Weight
-    value_weights: dict  # Value Weights
+    weight_arr: np.ndarray  # Issue Weight as a single element array
+    value_index: dict  # Index of each value in value_weights_arr
+    value_weights_arr: np.ndarray  # Value Weights
+    on_change = None  # Called without arguments when a weight changes
 
     def __init__(self, values: DiscreteValueSet, **kwargs):
         """
@@ -169,8 +331,31 @@ class Issue:
         :param values: The set of discrete value set
         :param kwargs: Additional parameters if needed
         """
-        # Initial value weights are zero
-        self.value_weights = {value: 0.0 + 1e-10 for value in values}
+        self.value_index = {value: i for i, value in enumerate(values)}
+
+        # Initial issue weight is one, initial value weights are zero
+        self.weight_arr = np.ones(1, dtype=np.float32)
+        self.value_weights_arr = np.full(len(self.value_index), 0.0 + 1e-10, dtype=np.float32)
+
+    @property
+    def weight(self) -> float:
+        """
+            Issue weight
+        :return: Issue weight as float
+        """
+        return float(self.weight_arr[0])
+
+    @weight.setter
+    def weight(self, weight: float):
+        """
+            Set the issue weight
+        :param weight: New issue weight
+        :return: None
+        """
+        self.weight_arr[0] = weight
+
+        if self.on_change is not None:
+            self.on_change()
 
     def update(self, value: Value, **kwargs):
         """
@@ -182,7 +367,10 @@ class Issue:
         if value is None:
             return
 
-        self.value_weights[value] += 1.
+        self.value_weights_arr[self.value_index[value]] += 1.
+
+        if self.on_change is not None:
+            self.on_change()
 
     def get_utility(self, value: Value) -> float:
         """
@@ -193,7 +381,7 @@ class Issue:
         if value is None:
             return 0.0
 
-        return self.weight * self.value_weights[value]
+        return self.weight * float(self.value_weights_arr[self.value_index[value]])
 
 
 